@@ -5,9 +5,13 @@ import argparse
 import collections
 import csv
 import io
-import re
-import time
+import os
+import shutil
+import tempfile
+import weakref
 import zipfile
+from collections.abc import Container
+from datetime import date
 from pathlib import Path
 
 try:
@@ -19,8 +23,29 @@ except ImportError:
   import urllib.error
   _has_requests = False
 
+try:
+  import remotezip
+  _has_remotezip = True
+except ImportError:
+  _has_remotezip = False
+
+try:
+  import zstandard
+  _has_zstandard = True
+except ImportError:
+  _has_zstandard = False
+
+try:
+  from isal import isal_zlib
+  _has_isal = True
+except ImportError:
+  _has_isal = False
+
 
 # ** Database **
+_HEADER_TRANS = str.maketrans({'(': '', ')': '', '-': '_', ' ': '_'})
+
+
 class ReleasableAircraft:
   URL = 'https://registry.faa.gov/database/ReleasableAircraft.zip'
   HEADERS = {
@@ -85,66 +110,162 @@ class ReleasableAircraft:
       '': 'Invalid',
   }
 
-  def __init__(self, database_path: Path | None = None):
+  def __init__(
+      self,
+      database_path: Path | None = None,
+      remote: bool = False,
+      download_dir: Path | None = None,
+  ):
     self.database_path = database_path
+    self.download_dir = download_dir
+    self.remote = False
+    self._tmpfile = None
+    self._finalizer = None
+    self._zfile = None
     if self.database_path:
-      with open(self.database_path, 'rb') as f:
-        self._database = f.read()
-    else:
-      self._database = self.download()
-
-  def download(self):
-    if _has_requests:
+      self._zfile = zipfile.ZipFile(self.database_path, 'r')
+    elif remote and _has_remotezip:
+      # fetch the central directory and only the members that are read
+      # through HTTP range requests instead of the whole archive
       try:
-        r = requests.get(self.URL, headers=self.HEADERS)
-        return r.content
-      except requests.exceptions.RequestException as e:
-        print(f'Error downloading database: {e}')
-        raise e
-    else:
+        self._zfile = remotezip.RemoteZip(self.URL, headers=self.HEADERS)
+        self.remote = True
+      except (remotezip.RemoteZipError, requests.exceptions.RequestException) as e:
+        print(f'Range requests unavailable, downloading full database: {e}')
+    if not self._zfile:
+      self._tmpfile = self.download()
       try:
-        with urlopen(Request(url=self.URL, headers=self.HEADERS)) as res:
-          return res.read()
-      except urllib.error.URLError as e:
-        print(f'Error downloading database: {e}')
-        raise e
+        self._zfile = zipfile.ZipFile(self._tmpfile, 'r')
+      except BaseException:
+        self.close()
+        raise
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def close(self):
+    if self._zfile:
+      self._zfile.close()
+    if self._finalizer:
+      self._finalizer()
+      self._tmpfile = None
+
+  @staticmethod
+  def _discard(tmpfile):
+    tmpfile.close()
+    # already gone if save() moved it into place
+    Path(tmpfile.name).unlink(missing_ok=True)
+
+  def download(self):
+    # stream to a temp file so the archive is never held in memory. It is
+    # created in download_dir when given so save() can rename it into place
+    tmpfile = tempfile.NamedTemporaryFile(suffix='.zip', dir=self.download_dir, delete=False)
+    try:
+      if _has_requests:
+        try:
+          with requests.get(self.URL, headers=self.HEADERS, stream=True) as r:
+            for chunk in r.iter_content(chunk_size=1 << 20):
+              tmpfile.write(chunk)
+        except requests.exceptions.RequestException as e:
+          print(f'Error downloading database: {e}')
+          raise e
+      else:
+        try:
+          with urlopen(Request(url=self.URL, headers=self.HEADERS)) as res:
+            shutil.copyfileobj(res, tmpfile, 1 << 20)
+        except urllib.error.URLError as e:
+          print(f'Error downloading database: {e}')
+          raise e
+    except BaseException:
+      self._discard(tmpfile)
+      raise
+    # removed by close(), or when the instance is garbage collected or the
+    # interpreter exits for callers that never close it
+    self._finalizer = weakref.finalize(self, self._discard, tmpfile)
+    tmpfile.seek(0)
+    return tmpfile
 
   def save(self, database_path: Path | None = None):
     database_path = database_path or Path.cwd() / 'ReleasableAircraft.zip'
     try:
-      with open(database_path, 'wb') as f:
-        f.write(self._database)
-        self.database_path = database_path
-        print(f'Saved database to: {database_path}')
+      if self.remote and not self._tmpfile:
+        self._tmpfile = self.download()
+      if self._tmpfile:
+        self._tmpfile.flush()
+        try:
+          # a rename on the same filesystem, no bytes copied. Temp files are
+          # created 0600, so give it the mode open() would have used
+          umask = os.umask(0)
+          os.umask(umask)
+          os.chmod(self._tmpfile.name, 0o666 & ~umask)
+          os.replace(self._tmpfile.name, database_path)
+        except OSError:
+          self._tmpfile.seek(0)
+          with open(database_path, 'wb') as f:
+            shutil.copyfileobj(self._tmpfile, f, 1 << 20)
+      else:
+        shutil.copyfile(self.database_path, database_path)
+      self.database_path = database_path
+      print(f'Saved database to: {database_path}')
     except Exception as e:
       print(f'Error saving database: {e}')
 
   def list_files(self):
-    with zipfile.ZipFile(io.BytesIO(self._database), 'r') as zfile:
-      for file in zfile.namelist():
-        print(file)
+    for file in self._zfile.namelist():
+      print(file)
 
   @staticmethod
   def _tidy_header(text: str):
-    text = text.strip().lower()
-    text = re.sub(r'\(|\)', '', text)
-    text = re.sub(r'-| ', '_', text)
-    return text
-
-  def read_file(self, file: str):
-    with zipfile.ZipFile(io.BytesIO(self._database), 'r') as zfile:
-      with zfile.open(file) as f:
-        reader = csv.reader(io.TextIOWrapper(f, encoding='utf-8-sig'))
-        header = [self._tidy_header(x) for x in next(reader)[:-1]]
-        row = collections.namedtuple('row', header)
-        for r in reader:
-          dat = [x.strip() for x in r[:-1]]
-          if len(dat) == len(header):
-            yield row(*dat)
+    return text.strip().lower().translate(_HEADER_TRANS)
+
+  def read_rows(self, file: str, where: dict[str, Container[str]] | None = None):
+    # returns the tidied header and an iterator over each row as a plain tuple
+    f = io.TextIOWrapper(self._zfile.open(file), encoding='utf-8-sig', newline='')
+    try:
+      reader = csv.reader(f)
+      header = [self._tidy_header(x) for x in next(reader)[:-1]]
+      conds = [(header.index(col), vals) for col, vals in (where or {}).items()]
+    except BaseException:
+      f.close()
+      raise
+    return header, self._iter_rows(f, reader, len(header) + 1, conds)
+
+  @staticmethod
+  def _iter_rows(f, reader, ncols: int, conds: list[tuple[int, Container[str]]]):
+    # filter on the raw cells so rejected rows are never stripped or copied
+    # into a tuple; conditions are checked in the order given and a row is
+    # dropped at the first one it fails. ncols includes the empty cell after
+    # the trailing comma on every line
+    with f:
+      for r in reader:
+        if len(r) != ncols:
+          continue
+        for i, vals in conds:
+          if r[i].strip() not in vals:
+            break
+        else:
+          r.pop()
+          yield tuple(map(str.strip, r))
+
+  def read_file(self, file: str, where: dict[str, Container[str]] | None = None):
+    header, rows = self.read_rows(file, where=where)
+    row = collections.namedtuple('row', header)
+    yield from map(row._make, rows)
 
   @staticmethod
   def format_date(dt: str | None = None):
-    return time.strftime('%Y-%m-%d', time.strptime(dt, '%Y%m%d')) if dt else ''
+    # YYYYMMDD -> YYYY-MM-DD, blank if it is not a valid date
+    if not dt or len(dt) != 8:
+      return ''
+    iso = f'{dt[:4]}-{dt[4:6]}-{dt[6:8]}'
+    try:
+      date.fromisoformat(iso)
+    except ValueError:
+      return ''
+    return iso
 
   @staticmethod
   def format_zip(zip: str | None = None):
@@ -176,85 +297,127 @@ DRONE_DATA_HEADERS = [
     'cancel_date',
 ]
 
+# MASTER.txt and DEREG.txt columns in DRONE_DATA_HEADERS order, without the
+# ACFTREF fields
+_MASTER_COLUMNS = (
+    'n_number',
+    'serial_number',
+    'mode_s_code',
+    'mode_s_code_hex',
+    'mfr_mdl_code',
+    'type_registrant',
+    'city',
+    'state',
+    'zip_code',
+    'status_code',
+    'cert_issue_date',
+    'air_worth_date',
+    'last_action_date',
+    None,  # cancel_date - DEREG only
+)
 
-def is_drone(acft_type: str, eng_type: str):
-  return (
-      acft_type == DRONE_AIRCRAFT_TYPE
-  ) and (
-      eng_type == DRONE_ENGINE_TYPE
-  )
+_DEREG_COLUMNS = (
+    'n_number',
+    'serial_number',
+    'mode_s_code',
+    'mode_s_code_hex',
+    'mfr_mdl_code',
+    'indicator_group',
+    'city_mail',
+    'state_abbrev_mail',
+    'zip_code_mail',
+    'status_code',
+    'cert_issue_date',
+    'air_worth_date',
+    'last_act_date',
+    'cancel_date',
+)
 
+# csv.writer's default dialect, written directly: fields are comma joined and
+# rows end in \r\n
+_DRONE_DATA_ROW = ','.join(['{}'] * len(DRONE_DATA_HEADERS)) + '\r\n'
 
-def parse_drone_data(outfile: Path, database_path: Path | None = None):
-  ra = ReleasableAircraft(database_path=database_path)
 
-  # ACFTREF.txt - drone manufacturer and model lookup
-  mfr_mdls = {
-      mm.code: mm for mm in ra.read_file('ACFTREF.txt')
-      if is_drone(mm.type_acft, mm.type_eng)
-  }
+def _csv_escape(text: str):
+  # quote a free text field the way csv.QUOTE_MINIMAL would
+  if ',' in text or '"' in text or '\n' in text or '\r' in text:
+    return '"' + text.replace('"', '""') + '"'
+  return text
 
-  with open(outfile, 'w', newline='') as f:
-    writer = csv.writer(f)
-    writer.writerow(DRONE_DATA_HEADERS)
-
-    # MASTER.txt
-    for ac in ra.read_file('MASTER.txt'):
-      if not is_drone(ac.type_aircraft, ac.type_engine):
-        continue
-      # lookup manufacturer and model
-      mfr_mdl = mfr_mdls.get(ac.mfr_mdl_code)
-      if mfr_mdl:
-        writer.writerow([
-            ac.n_number,
-            ac.serial_number,
-            ac.mode_s_code,
-            ac.mode_s_code_hex,
-            ac.mfr_mdl_code,
-            mfr_mdl.mfr,
-            mfr_mdl.model,
-            mfr_mdl.no_eng,
-            mfr_mdl.ac_weight,
-            ra.REGISTRANT_TYPES.get(ac.type_registrant, ''),
-            ac.city,
-            ac.state,
-            ra.format_zip(ac.zip_code),
-            ra.STATUS_CODES.get(ac.status_code, ''),
-            ra.format_date(ac.cert_issue_date),
-            ra.format_date(ac.air_worth_date),
-            ra.format_date(ac.last_action_date),
-            '',  # cancel date - DEREG only
-        ])
-
-    # DEREG.txt
-    for ac in ra.read_file('DEREG.txt'):
-      # lookup manufacturer and model
-      mfr_mdl = mfr_mdls.get(ac.mfr_mdl_code)
-      if mfr_mdl:
-        writer.writerow([
-            ac.n_number,
-            ac.serial_number,
-            ac.mode_s_code,
-            ac.mode_s_code_hex,
-            ac.mfr_mdl_code,
-            mfr_mdl.mfr,
-            mfr_mdl.model,
-            mfr_mdl.no_eng,
-            mfr_mdl.ac_weight,
-            ra.REGISTRANT_TYPES.get(ac.indicator_group, ''),
-            ac.city_mail,
-            ac.state_abbrev_mail,
-            ra.format_zip(ac.zip_code_mail),
-            ra.STATUS_CODES.get(ac.status_code, ''),
-            ra.format_date(ac.cert_issue_date),
-            ra.format_date(ac.air_worth_date),
-            ra.format_date(ac.last_act_date),
-            ra.format_date(ac.cancel_date),
-        ])
+
+def parse_drone_data(outfile: Path, database_path: Path | None = None, compress: bool = False):
+  with ReleasableAircraft(database_path=database_path, remote=True) as ra:
+    _write_drone_data(ra, outfile, compress=compress)
 
   print(f'Saved drone data to: {outfile}')
 
 
+def _open_output(outfile: Path, compress: bool = False):
+  if not compress:
+    return open(outfile, 'w', newline='', buffering=1 << 20)
+  cctx = zstandard.ZstdCompressor(level=3, threads=-1)
+  return io.TextIOWrapper(cctx.stream_writer(open(outfile, 'wb')), newline='')
+
+
+def _write_drone_data(ra: ReleasableAircraft, outfile: Path, compress: bool = False):
+  # ACFTREF.txt - drone manufacturer and model lookup, joined against
+  # MASTER.txt and DEREG.txt on mfr_mdl_code while they are read. Only the
+  # four output columns are kept, already escaped for the csv
+  mfr_mdls = {
+      mm.code: (_csv_escape(mm.mfr), _csv_escape(mm.model), mm.no_eng, mm.ac_weight)
+      for mm in ra.read_file('ACFTREF.txt', where={
+          'type_acft': {DRONE_AIRCRAFT_TYPE},
+          'type_eng': {DRONE_ENGINE_TYPE},
+      })
+  }
+
+  # bind per-row callables once, outside the row generator
+  get_registrant = ra.REGISTRANT_TYPES.get
+  get_status = ra.STATUS_CODES.get
+  format_zip = ra.format_zip
+  format_date = ra.format_date
+  format_row = _DRONE_DATA_ROW.format
+
+  def drone_rows(file: str, columns: tuple[str | None, ...], where: dict[str, Container[str]]):
+    header, rows = ra.read_rows(file, where=where)
+    (
+        i_n_number, i_serial_number, i_mode_s_code, i_mode_s_code_hex,
+        i_mfr_mdl_code, i_type_registrant, i_city, i_state, i_zip_code,
+        i_status_code, i_cert_issue_date, i_air_worth_date, i_last_action_date,
+        i_cancel_date,
+    ) = [header.index(col) if col else None for col in columns]
+    for ac in rows:
+      mfr_mdl_code = ac[i_mfr_mdl_code]
+      yield format_row(
+          ac[i_n_number],
+          _csv_escape(ac[i_serial_number]),
+          ac[i_mode_s_code],
+          ac[i_mode_s_code_hex],
+          mfr_mdl_code,
+          *mfr_mdls[mfr_mdl_code],  # mfr, model, no_eng, ac_weight
+          get_registrant(ac[i_type_registrant], ''),
+          _csv_escape(ac[i_city]),
+          ac[i_state],
+          format_zip(ac[i_zip_code]),
+          get_status(ac[i_status_code], ''),
+          format_date(ac[i_cert_issue_date]),
+          format_date(ac[i_air_worth_date]),
+          format_date(ac[i_last_action_date]),
+          format_date(ac[i_cancel_date]) if i_cancel_date is not None else '',
+      )
+
+  with _open_output(outfile, compress=compress) as f:
+    f.write(_DRONE_DATA_ROW.format(*DRONE_DATA_HEADERS))
+    f.writelines(drone_rows('MASTER.txt', _MASTER_COLUMNS, where={
+        'type_aircraft': {DRONE_AIRCRAFT_TYPE},
+        'type_engine': {DRONE_ENGINE_TYPE},
+        'mfr_mdl_code': mfr_mdls,
+    }))
+    f.writelines(drone_rows('DEREG.txt', _DEREG_COLUMNS, where={
+        'mfr_mdl_code': mfr_mdls,
+    }))
+
+
 def _valid_dir(path: Path | str):
   if not isinstance(path, Path):
     path = Path(path)
@@ -271,6 +434,15 @@ def _valid_file(path: Path | str):
   return path
 
 
+def _use_isal_zlib():
+  # ISA-L deflate and crc32 as a drop-in for zlib when unpacking the archive.
+  # This swaps zipfile's zlib for the whole process, so it is only done when
+  # running as a script, never on import
+  if _has_isal:
+    zipfile.zlib = isal_zlib
+    zipfile.crc32 = isal_zlib.crc32
+
+
 def main():
   parser = argparse.ArgumentParser(
       formatter_class=argparse.RawTextHelpFormatter,
@@ -305,15 +477,29 @@ def main():
         ''',
   )
 
+  parser.add_argument(
+      '--zstd',
+      action='store_true',
+      help='''
+        Compress the extracted drone registration csv file with zstandard
+        (ReleasableDrone.csv.zst)
+        ''',
+  )
+
   args = parser.parse_args()
 
+  if args.zstd and not _has_zstandard:
+    parser.error('--zstd requires the zstandard package')
+
+  _use_isal_zlib()
+
   if args.save_db:
     outfile = args.data_dir / 'ReleasableAircraft.zip'
-    ra = ReleasableAircraft()
-    ra.save(database_path=outfile)
+    with ReleasableAircraft(download_dir=args.data_dir) as ra:
+      ra.save(database_path=outfile)
   else:
-    outfile = args.data_dir / 'ReleasableDrone.csv'
-    parse_drone_data(database_path=args.database, outfile=outfile)
+    outfile = args.data_dir / ('ReleasableDrone.csv.zst' if args.zstd else 'ReleasableDrone.csv')
+    parse_drone_data(database_path=args.database, outfile=outfile, compress=args.zstd)
 
 
 if __name__ == '__main__':